@@ -2,18 +2,103 @@
 # -*- coding: utf-8 -*-
 
 import os
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy as np
 from matplotlib import pyplot as plt
 
 __version__ = '0.2.0'
 __author__ = 'Ciro Emmanuel-Martinez'
 
+# Rows formatted per write in StackedPg.save (bounds the memory used by the text output):
+_SAVE_BLOCK_ROWS = 65536
+
+# Binary cache of the accumulated periodograms, kept inside the work folder:
+_CACHE_FILE = '_StackedPG_cache.npz'
+
+def _trapz(y, dx):
+    """Trapezoidal integral of 'y' (along its last axis, so each row of a matrix is integrated)
+    for a grid with spacings 'dx'.
+    'dx' is a scalar for uniform grids, otherwise the array of successive differences."""
+    if np.ndim(dx) == 0:
+        return dx * (y.sum(axis=-1) - 0.5 * (y[..., 0] + y[..., -1]))
+    return 0.5 * np.dot(y[..., 1:] + y[..., :-1], dx)
+
+def _describe_error(e, verbose):
+    """Text reported in 'error_files' for an exception: its type name, or its message if 'verbose'."""
+    return type(e).__name__ + ": " + str(e) if verbose else type(e).__name__
+
+def _fingerprint(pg_entries):
+    """Identifies the current contents of the periodogram files (os.DirEntry objects) for the cache.
+    Returns the lists of names, sizes and modification times (ns), sorted by name."""
+    stats = sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in pg_entries)
+    return [s[0] for s in stats], [s[1] for s in stats], [s[2] for s in stats]
+
+def _load_pg(path, comments, delimiter, skiprows, verbose):
+    """Reads a single periodogram file.
+    Returns a tuple (array, None), or (None, error text) if the file cannot be read.
+    Only I/O and parsing errors are caught (UnicodeDecodeError is a ValueError)."""
+    try:
+        return np.loadtxt(path, comments=comments, delimiter=delimiter, skiprows=skiprows, ndmin=2), None
+    except (OSError, ValueError) as e:
+        return None, _describe_error(e, verbose)
+
+def _load_in_order(load, paths, workers):
+    """Yields load(path) for each path, in order, running up to 'workers' loads concurrently.
+    No more than 'workers' results are ever pending, however slow the earlier loads are."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(load, path))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _grid_spacing(frecs):
+    """Spacing of the frequency grid, as expected by _trapz."""
+    dx = np.diff(frecs)
+    # Purely relative test: an absolute tolerance would class any grid with tiny steps as uniform
+    if np.allclose(dx, dx[0], rtol=1e-6, atol=0):
+        return (frecs[-1] - frecs[0]) / (frecs.size - 1)
+    return dx
+
+def _accumulate_pg(power, dx, log_and, neg_and, sum_or):
+    """Normalizes a periodogram's power column and adds it to the running sums of the AND (as logs
+    of the magnitudes, plus the count of negative values giving the sign) and OR stacked periodograms.
+    'power' is used as scratch space (it holds the logs on return)."""
+    power *= 1.0 / _trapz(power, dx)
+    sum_or += power
+    # Negative values (e.g. round-off around zero) have no log, so their sign is counted apart:
+    neg_and += power < 0
+    # The AND product underflows for many periodograms, so it is accumulated as a sum of logs.
+    # Zero power gives log(0) = -inf, which maps back to zero:
+    np.abs(power, out=power)
+    with np.errstate(divide='ignore'):
+        np.log(power, out=power)
+    log_and += power
+
+def _finish_stack(log_and, neg_and, sum_or, dx):
+    """Returns the normalized AND and OR stacked power columns from the running sums."""
+    # Rescaled to its peak before leaving log space (the constant factor is removed by the
+    # normalization). Bins that are zero (-inf) or invalid (NaN) must not set the peak:
+    finite = np.isfinite(log_and)
+    peak = log_and[finite].max() if finite.any() else 0.0
+    stacked_and = np.exp(log_and - peak)
+    stacked_and[neg_and % 2 == 1] *= -1
+    stacked_and /= _trapz(stacked_and, dx)
+    return stacked_and, sum_or / _trapz(sum_or, dx)
+
 class StackedPg:
     """Generates a stacked periodogram objects from the files existing in a 'folder' passed
     at initialization.
     The files in the folder must be plain files of individual periodograms, with at least two columns:
     - frequency
     - power
+    All the periodograms must share the same frequencies (those of the first file read).
     Any file that cannot be decoded / incorporated will be ignored (and reported)
     
     Parameters
@@ -31,6 +116,13 @@ class StackedPg:
     - ref_colors: a list containing the colors for reference lines.
     - ref_styles: a list containing the styles for reference lines.
     Note: defaults are provided for 'colors' and 'styles' if not specified.
+    - cache: if True (default), the accumulated periodograms are stored in a binary file in the folder
+    ('_StackedPG_cache.npz') and reused in later runs while the periodogram files keep the same names,
+    sizes and modification times.
+    - precision: the dtype used to store the result, 'float64' (default) or 'float32'. The calculation
+    is always done in float64. Note that 'float32' also rounds the frequencies (to ~7 significant digits),
+    which may merge neighbouring frequencies of fine grids.
+    - verbose: if True, 'error_files' reports the full error of each file instead of just its type.
     
     Attributes
     ----------
@@ -40,17 +132,21 @@ class StackedPg:
         - frecs
         - AND (multiplication)
         - OR (addition)
-    - error_files: a list of the files under which could not be incorporated into the stacked periodogram.
+    - error_files: a list of the files under which could not be incorporated into the stacked periodogram,
+    as tuples (file name, error type name or, if 'verbose', the error itself).
         
     Methods
     -------
     - _calcStacked: calculates the stacked periodograms (called upon instance initialization).
+    - _readPgs: parses the individual periodogram files and accumulates them.
+    - _readCache / _writeCache: loads / stores the accumulated periodograms from / to the binary cache.
     - plot: plots the calculated stacked periodograms and (optionally) saves them to a file.
-    - save: saves the stacked periodograms into a text file.
+    - save: saves the stacked periodograms into a text file (or a binary '.npy' file).
     """
     
     def __init__(self, folder, case_name=None, header=False, sep=' ', comments="#", ref_lines=[],
-                 ref_colors=None, ref_styles=None):
+                 ref_colors=None, ref_styles=None, cache=True, precision='float64',
+                 verbose=False):
         self.folder = folder
         if case_name is None:
             self.case_name = self.folder
@@ -68,104 +164,211 @@ class StackedPg:
             self.ref_styles = ['-', '--', '-.', ':']
         else:
             self.ref_styles = ref_styles
+        self.cache = cache
+        self.precision = precision
+        self.verbose = verbose
         self.error_files = []
         self.stacked = None
         self._calcStacked()
     
     def _calcStacked(self):
         """ Calculates both stacked periodograms: AND and OR"""
-        #pg_files = os.listdir(self.folder)
-        pg_files = [f for f in os.listdir(self.folder) if os.path.isfile(self.folder + f)]
+        # DirEntry objects carry the file type (and, once queried, the stat) without extra syscalls:
+        with os.scandir(self.folder) as entries:
+            # (also skipping temporary cache files left behind by an interrupted write)
+            pg_entries = [e for e in entries if e.is_file() and not e.name.startswith(_CACHE_FILE)]
+        cache_path = os.path.join(self.folder, _CACHE_FILE)
+        if self.cache:
+            # Taken before parsing, so a file rewritten meanwhile will not match it in later runs:
+            fingerprint = _fingerprint(pg_entries)
+            cached = self._readCache(cache_path, fingerprint)
+        else:
+            cached = None
+        if cached is None:
+            frecs, log_and, neg_and, sum_or, names = self._readPgs(pg_entries)
+            if self.cache:
+                self._writeCache(cache_path, fingerprint, frecs, log_and, neg_and, sum_or, names)
+        else:
+            frecs, log_and, neg_and, sum_or = cached
+        stacked_and, stacked_or = _finish_stack(log_and, neg_and, sum_or, _grid_spacing(frecs))
+        # Construct the array (filled column by column, casting to the stored precision):
+        self.stacked = np.empty((frecs.size, 3), dtype=self.precision)
+        self.stacked[:, 0] = frecs
+        self.stacked[:, 1] = stacked_and
+        self.stacked[:, 2] = stacked_or
+
+    def _readPgs(self, pg_entries):
+        """ Parses the periodogram files (os.DirEntry objects), reporting the failing ones in 'error_files'.
+        Each periodogram is folded into running sums as soon as it is read, so only one grid-sized
+        array per operation is kept, whatever the number of files.
+        Returns the frequencies, the running sums (log AND, negative count of AND, and OR) and the names
+        of the files incorporated.
+        Raises ValueError if no file could be incorporated"""
+        # loadtxt splits on any whitespace when no delimiter is given
+        delimiter = None if self.sep == ' ' else self.sep
+        skiprows = 1 if self.header else 0
+        # The files are independent, so they are parsed concurrently (in a bounded window, so that
+        # only the files in flight are held in memory):
+        load_pg = partial(_load_pg, comments=self.comments, delimiter=delimiter, skiprows=skiprows,
+                          verbose=self.verbose)
         frecs = None
-        stacked_and = None
-        stacked_or = None
-        for f in pg_files:
+        names = []
+        # Locals for the per-file loop (avoids attribute lookups on every iteration):
+        report_error = self.error_files.append
+        add_name = names.append
+        array_equal = np.array_equal
+        accumulate_pg = _accumulate_pg
+        loaded = _load_in_order(load_pg, [e.path for e in pg_entries], os.cpu_count() or 1)
+        for f, (new_pg, error) in zip([e.name for e in pg_entries], loaded):
+            if error is not None:
+                report_error((f, error))
+                continue
             try:
-                new_pg = np.genfromtxt(self.folder + f, comments=self.comments, delimiter=self.sep)
-                # Normalize individual PG:
-                new_pg[:, 1] = new_pg[:, 1] / np.trapz(y=new_pg[:, 1], x=new_pg[:, 0])
+                power = new_pg[:, 1]
                 if frecs is None:
-                    frecs = new_pg[:, 0].copy()
-                    stacked_and = new_pg[:, 1].copy()
-                    stacked_or = new_pg[:, 1].copy()
-                else:
-                    stacked_and = stacked_and * new_pg[:, 1]
-                    stacked_or = stacked_or + new_pg[:, 1]
-            except Exception as e:
-                self.error_files.append((f, str(e)))
-        # Normalize the stacked periodograms:
-        stacked_and = stacked_and / np.trapz(y=stacked_and, x=frecs)
-        stacked_or = stacked_or / np.trapz(y=stacked_or, x=frecs)
-        # Construct the array:
-        self.stacked = np.vstack((frecs, stacked_and, stacked_or)).T
-        
+                    dx = _grid_spacing(new_pg[:, 0])
+                    # A view: it keeps the first parsed array alive, but frecs is never modified.
+                    # Only set once the file has proved usable:
+                    frecs = new_pg[:, 0]
+                    log_and = np.zeros_like(frecs)
+                    neg_and = np.zeros(frecs.shape, dtype=np.intp)
+                    sum_or = np.zeros_like(frecs)
+                elif not array_equal(new_pg[:, 0], frecs):
+                    # The normalization and the stacking assume a single frequency grid
+                    report_error((f, "Frequencies differ from those of the first periodogram"))
+                    continue
+                accumulate_pg(power, dx, log_and, neg_and, sum_or)
+                add_name(f)
+            # A single column, or a single row in the file that fixes the grid:
+            except IndexError as e:
+                report_error((f, _describe_error(e, self.verbose)))
+        if frecs is None:
+            raise ValueError("No usable periodogram in folder '%s'; files with errors: %s"
+                             % (self.folder, self.error_files))
+        return frecs, log_and, neg_and, sum_or, names
+
+    def _readCache(self, cache_path, fingerprint):
+        """ Loads the running sums of the periodograms from the binary cache, restoring 'error_files'.
+        Returns (frecs, log_and, neg_and, sum_or), or None if there is no cache or it is outdated: written with
+        other parsing options, or for files that do not match 'fingerprint' exactly (names, sizes and
+        modification times).
+        An unreadable or corrupt cache is also treated as missing (it is rebuilt)"""
+        try:
+            if not os.path.isfile(cache_path):
+                return None
+            with np.load(cache_path) as data:
+                if ('fp_names' not in data.files
+                        or data['options'].tolist() != [self.sep, self.comments, str(self.header), str(self.verbose)]
+                        or data['fp_names'].tolist() != fingerprint[0]
+                        or data['fp_sizes'].tolist() != fingerprint[1]
+                        or data['fp_mtimes'].tolist() != fingerprint[2]):
+                    return None
+                error_files = list(zip(data['error_names'].tolist(), data['error_msgs'].tolist()))
+                cached = data['frecs'], data['log_and'], data['neg_and'], data['sum_or']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        self.error_files.extend(error_files)
+        return cached
+
+    def _writeCache(self, cache_path, fingerprint, frecs, log_and, neg_and, sum_or, names):
+        """ Stores the running sums of the periodograms (and the files that failed) in the binary cache,
+        along with the 'fingerprint' of the files they come from.
+        The cache is written to a temporary file and then moved into place, so an interrupted write never
+        leaves a truncated cache. If the folder cannot be written, caching is skipped"""
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', prefix=_CACHE_FILE, dir=self.folder)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                np.savez(out, frecs=frecs, log_and=log_and, neg_and=neg_and, sum_or=sum_or,
+                         names=np.array(names, dtype=str),
+                         fp_names=np.array(fingerprint[0], dtype=str),
+                         fp_sizes=np.array(fingerprint[1], dtype=np.int64),
+                         fp_mtimes=np.array(fingerprint[2], dtype=np.int64),
+                         error_names=np.array([e[0] for e in self.error_files], dtype=str),
+                         error_msgs=np.array([e[1] for e in self.error_files], dtype=str),
+                         options=np.array([self.sep, self.comments, str(self.header), str(self.verbose)]))
+            os.replace(tmp_path, cache_path)
+        except BaseException as e:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            # Failing to cache (e.g. a full disk) does not invalidate the result:
+            if not isinstance(e, OSError):
+                raise
+
     def plot(self, showfig=True, savefig=False, combined=False):
         """ Plots the resulting stacked periodograms.
         Optionally, the figure can also be saved to a 'jpg' file.
-        The parameter 'combined' is used to generate a single plot or a separate plot"""
+        The parameter 'combined' is used to generate a single plot or a separate plot.
+        The figure is closed after saving when it is not shown, to release its memory"""
+        # (color, style) of each reference line, cycling through the configured lists:
+        n_colors = len(self.ref_colors)
+        n_styles = len(self.ref_styles)
+        ref_formats = [(self.ref_colors[i % n_colors], self.ref_styles[i % n_styles])
+                       for i in range(len(self.ref_lines))]
         if combined == True:
-            plt.figure(figsize=(15.0, 5.0))
-            plt.plot(self.stacked[:,0], self.stacked[:,1], label="AND operation")
-            plt.plot(self.stacked[:,0], self.stacked[:,2], label="OR operation")
-            mark_count = 0
-            for refline in self.ref_lines:
-                c_idx = mark_count % len(self.ref_colors)
-                s_idx = mark_count % len(self.ref_styles)
-                plt.axvline(x=refline[0],
-                            color=self.ref_colors[c_idx], linestyle=self.ref_styles[s_idx],
-                            label=refline[1])
-                mark_count += 1
+            fig = plt.figure(figsize=(15.0, 5.0))
+            plt.plot(self.stacked[:,0], self.stacked[:,1], label="AND operation", rasterized=True)
+            plt.plot(self.stacked[:,0], self.stacked[:,2], label="OR operation", rasterized=True)
+            for (x, label), (color, style) in zip(self.ref_lines, ref_formats):
+                plt.axvline(x=x, color=color, linestyle=style, label=label)
             plt.title(self.case_name + " Stacked periodograms", fontdict = {'fontsize' : 20})
             plt.xlabel("Frequency", fontsize=12)
             plt.ylabel("Normalized power", fontsize=12)
             plt.legend()
+            # Saved before showing: closing the shown window discards the figure
+            if savefig == True:
+                fig.savefig(self.folder + self.case_name + "_StackedPG_Combined.jpg", format='jpg', dpi=150)
             if showfig == True:
                 plt.show()
-            if savefig == True:
-                plt.savefig(self.folder + self.case_name + "_StackedPG_Combined.jpg", format='jpg')
+            else:
+                plt.close(fig)
         else:
             fig, axs = plt.subplots(nrows=2, ncols=1, figsize=(15.0, 10.0))
             fig.suptitle(self.case_name + " Stacked periodograms", fontsize=20)
-            axs[0].plot(self.stacked[:,0], self.stacked[:,1])
+            axs[0].plot(self.stacked[:,0], self.stacked[:,1], rasterized=True)
             axs[0].set_title("AND operation", fontsize = 16)
             axs[0].set_xlabel("Frequency", fontsize = 12)
             axs[0].set_ylabel("Normalized power", fontsize=16)
-            mark_count = 0
-            for refline in self.ref_lines:
-                c_idx = mark_count % len(self.ref_colors)
-                s_idx = mark_count % len(self.ref_styles)
-                axs[0].axvline(x=refline[0],
-                               color=self.ref_colors[c_idx], linestyle=self.ref_styles[s_idx],
-                               label=refline[1])
-                mark_count += 1
-            axs[1].plot(self.stacked[:,0], self.stacked[:,2])
+            for (x, label), (color, style) in zip(self.ref_lines, ref_formats):
+                axs[0].axvline(x=x, color=color, linestyle=style, label=label)
+            axs[1].plot(self.stacked[:,0], self.stacked[:,2], rasterized=True)
             #axs[1].set_title("OR operation", fontdict = {'fontsize' : 16})
             axs[1].set_title("OR operation", fontsize=16)
             axs[1].set_xlabel("Frequency", fontsize=12)
             axs[1].set_ylabel("Normalized power", fontsize=12)
-            mark_count = 0
-            for refline in self.ref_lines:
-                c_idx = mark_count % len(self.ref_colors)
-                s_idx = mark_count % len(self.ref_styles)
-                axs[1].axvline(x=refline[0],
-                               color=self.ref_colors[c_idx], linestyle=self.ref_styles[s_idx],
-                               label=None)
-                mark_count += 1
+            for (x, _), (color, style) in zip(self.ref_lines, ref_formats):
+                axs[1].axvline(x=x, color=color, linestyle=style, label=None)
             fig.tight_layout(pad=1.5, h_pad=1.5)
             
             fig.legend()
             
+            if savefig == True:
+                fig.savefig(self.folder + self.case_name + "_StackedPG_Separate.jpg", format='jpg', dpi=150)
             if showfig == True:
                 fig.show()
-            if savefig == True:
-                plt.savefig(self.folder + self.case_name + "_StackedPG_Separate.jpg", format='jpg')
+            else:
+                plt.close(fig)
                 
-    def save(self, header=True, sep=' '):
+    def save(self, header=True, sep=' ', binary=False):
         """ Saves the stacked periodograms, a single file with three columns 
-        is generated (frecs, AND, OR)"""
-        if header == False:
-            header_text = ""
-        else:
-            header_text = "frec" + sep + "AND" + sep + "OR"
-        np.savetxt(self.folder + self.case_name + "_StackedPG.dat", self.stacked,
-                   fmt='%.9f', delimiter=sep, header=header_text, comments=self.comments)
+        is generated (frecs, AND, OR).
+        If 'binary' is True, the array is saved in NumPy's '.npy' format instead
+        ('header' and 'sep' are then ignored)"""
+        if binary == True:
+            np.save(self.folder + self.case_name + "_StackedPG.npy", self.stacked)
+            return
+        # As many significant digits as the stored precision holds:
+        fmt = '%.7g' if self.stacked.dtype == np.float32 else '%.16g'
+        # Rows are formatted a block at a time in a single operation (np.savetxt formats and writes
+        # row by row):
+        row_fmt = sep.join([fmt] * 3) + '\n'
+        with open(self.folder + self.case_name + "_StackedPG.dat", 'w') as out:
+            if header == True:
+                out.write(self.comments + "frec" + sep + "AND" + sep + "OR" + '\n')
+            for start in range(0, len(self.stacked), _SAVE_BLOCK_ROWS):
+                block = self.stacked[start:start + _SAVE_BLOCK_ROWS]
+                out.write((row_fmt * len(block)) % tuple(block.ravel().tolist()))